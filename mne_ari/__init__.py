@@ -1,3 +1,3 @@
-from .ari import all_resolutions_inference
+from .ari import all_resolutions_inference, PermutationEngine, merge_engines
 
 __version__ = "0.1.2"
@@ -1 +1,2 @@
 from .ari import all_resolutions_inference
+from .engine import PermutationEngine, merge_engines
@@ -0,0 +1,68 @@
+from scipy.sparse.csgraph import connected_components
+from scipy import ndimage, sparse
+import numpy as np
+
+'''
+Connected-component labelling for the threshold sweep. Gives the same
+clusters as mne.stats.cluster_level._find_clusters, but without importing
+MNE, and with the adjacency built into a single CSR graph once up front so
+each threshold only costs one scipy call.
+'''
+
+def _setup_adjacency(adjacency, n_tests, n_times):
+    '''
+    builds a CSR adjacency graph over all (flattened) tests from an adjacency
+    matrix over either all tests or just the last dimension, in which case
+    tests are also adjacent to the same vertex at neighbouring time points
+    (as in mne.stats.spatio_temporal_cluster_1samp_test)
+    '''
+    if not sparse.issparse(adjacency):
+        raise ValueError("If adjacency matrix is given, it must be a " +
+            "SciPy sparse matrix.")
+    if adjacency.shape[0] == n_tests:
+        return sparse.csr_matrix(adjacency)
+    got_times, mod = divmod(n_tests, adjacency.shape[0])
+    if got_times != n_times or mod != 0:
+        raise ValueError("adjacency (len %d) must be of the correct size, "
+            "i.e. be equal to or evenly divide the number of tests (%d)."
+            % (adjacency.shape[0], n_tests))
+    n_vertices = adjacency.shape[0]
+    spatial = sparse.kron(sparse.eye(n_times), adjacency)
+    temporal = sparse.kron(sparse.eye(n_times, k = 1), sparse.eye(n_vertices))
+    return sparse.csr_matrix(spatial + temporal)
+
+def _find_clusters(x, threshold, tail = -1, adjacency = None):
+    '''
+    finds clusters of connected tests where x < threshold (tail = -1)
+    or x > threshold (tail = 1)
+
+    If adjacency is None, x is treated as a lattice (each test is adjacent
+    to its neighbours along each axis). If adjacency is False, no tests are
+    adjacent. Otherwise x should be flattened and adjacency be a CSR matrix
+    from _setup_adjacency.
+
+    Returns a list of boolean masks of x.shape, one per cluster.
+    '''
+    if tail == -1:
+        x_in = x < threshold
+    elif tail == 1:
+        x_in = x > threshold
+    else:
+        raise ValueError("tail must be -1 or 1.")
+    if not np.any(x_in):
+        return []
+    if adjacency is None:
+        labels, n_labels = ndimage.label(x_in)
+    elif adjacency is False: # every test is its own cluster
+        idxs = np.flatnonzero(x_in)
+        n_labels = idxs.size
+        labels = np.zeros(x.shape, dtype = int)
+        labels[idxs] = np.arange(1, n_labels + 1)
+    else:
+        # label connected components of the subgraph of tests in x_in
+        idxs = np.flatnonzero(x_in)
+        subgraph = adjacency[idxs][:, idxs]
+        n_labels, components = connected_components(subgraph, directed = False)
+        labels = np.zeros(x.shape, dtype = int)
+        labels[idxs] = components + 1
+    return [labels == label for label in range(1, n_labels + 1)]
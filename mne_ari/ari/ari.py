@@ -1,18 +1,39 @@
-from mne.stats.cluster_level import (
-    _find_clusters, 
-    _setup_adjacency,
-    _reshape_clusters,  
-    _cluster_indices_to_mask
-     )
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 import numpy as np
+import os
 
+from ._clusters import _find_clusters, _setup_adjacency
 from .parametric import ARI 
 from .permutation import pARI 
 
 
+def _sweep_thresholds(ari, p_vals, thresholds, adjacency = None):
+    '''
+    computes the highest true discovery proportion for each coordinate in
+    p_vals across the clusters formed at each of the given thresholds
+    '''
+    true_discovery_proportions = np.zeros_like(p_vals)
+    if adjacency is not None:
+        p_vals = p_vals.flatten() # flatten once, not for every threshold
+    for thres in thresholds:
+        clusters = _find_clusters(p_vals, thres, -1, adjacency)
+        if adjacency is not None: # reshape to boolean mask 
+            clusters = [c.reshape(true_discovery_proportions.shape) for c in clusters]
+        for clust in clusters:
+            # compute the true-positive proportion for this cluster
+            tdp = ari.true_discovery_proportion(clust)
+            # update results array if new TPF > old TPF
+            tdp_old = true_discovery_proportions[clust]
+            tdp_new = np.full_like(tdp_old, tdp)
+            tdps = np.stack([tdp_old, tdp_new], axis = 0)
+            true_discovery_proportions[clust] = tdps.max(axis = 0)
+    return true_discovery_proportions
+
+
 def all_resolutions_inference(X, alpha = .05, tail = 0, ari_type = 'parametric',
     adjacency = None, n_permutations = 10000, thresholds = None, 
-    seed = None, statfun = None, shift = 0):
+    seed = None, statfun = None, shift = 0, chunk_size = None, n_jobs = 1):
     '''
     Implements all-resolutions inference as in [1] or [2].
 
@@ -22,7 +43,9 @@ def all_resolutions_inference(X, alpha = .05, tail = 0, ari_type = 'parametric',
     Parameters
     ----------
         x: (n_observation, n_times, n_vertices) array for one-sample/paired test
-            or a list of two such arrays for independent sample test
+            or a list of two such arrays for independent sample test,
+            or a PermutationEngine to reuse permutations already run
+            (e.g. to run both types of ARI with one permutation pass)
         alpha: (float) the false discovry control level
         tail: 1 or 'greater', 0 or 'two-sided', -1 or 'less';
                 ignored if statfun is provided.
@@ -45,6 +68,19 @@ def all_resolutions_inference(X, alpha = .05, tail = 0, ari_type = 'parametric',
                 an (n_observations, n_tests) array (or list of such arrays) 
                 as input and return an (n_tests,) array of p-values. If this
                 argument is used, the tail argument is ignored.
+        chunk_size: (int) optional, number of tests to process at a time.
+                The same sign flips/shuffles are replayed for every chunk, so
+                only one chunk of the data is ever loaded into memory. Use
+                this with memory-mapped inputs (e.g. np.memmap) that are
+                larger than memory. Custom statfuns must then compute each
+                test independently. Default is None (all tests at once).
+                For permutation-based ARI, the data are read from disk once
+                per block of permutations rather than once in total, since
+                its calibration needs every test for each permutation.
+        n_jobs: (int) number of threads to split the threshold sweep across.
+                Each thread keeps its own true discovery proportion map, and
+                these are combined (by elementwise max) at the end.
+                -1 uses all available CPUs. Default is 1 (no parallelism).
 
     Returns
     ----------
@@ -69,14 +105,14 @@ def all_resolutions_inference(X, alpha = .05, tail = 0, ari_type = 'parametric',
 
     # initialize ARI object, which computes p-value 
     if ari_type == 'parametric':
-        ari = ARI(X, alpha, tail, n_permutations, seed, statfun)
+        ari = ARI(X, alpha, tail, n_permutations, seed, statfun, chunk_size)
     elif ari_type == 'permutation':
-        ari = pARI(X, alpha, tail, n_permutations, seed, statfun, shift)
+        ari = pARI(X, alpha, tail, n_permutations, seed, statfun, shift,
+            chunk_size)
     else:
         raise ValueError("type must be 'parametric' or 'permutation'.")
     p_vals = ari.p_values
 
-    true_discovery_proportions = np.zeros_like(p_vals)
     n_times = p_vals.shape[0]
     n_tests = p_vals.size
 
@@ -97,26 +133,27 @@ def all_resolutions_inference(X, alpha = .05, tail = 0, ari_type = 'parametric',
             assert(thres >= 0)
             assert(thres <= 1)
 
-    for thres in thresholds:
-        if adjacency is None: # use lattice adjacency 
-            clusters, _ = _find_clusters(p_vals, thres, -1)
-        else:
-            clusters, _ = _find_clusters(p_vals.flatten(), thres, -1, adjacency)
-        if clusters: # reshape to boolean mask 
-            clusters = _cluster_indices_to_mask(clusters, n_tests)
-            clusters = _reshape_clusters(clusters, true_discovery_proportions.shape)
-        for clust in clusters:
-            # compute the true-positive proportion for this cluster
-            tdp = ari.true_discovery_proportion(clust)
-            # update results array if new TPF > old TPF
-            tdp_old = true_discovery_proportions[clust]
-            tdp_new = np.full_like(tdp_old, tdp)
-            tdps = np.stack([tdp_old, tdp_new], axis = 0)
-            true_discovery_proportions[clust] = tdps.max(axis = 0)
+    # sweep thresholds, in parallel if requested
+    if n_jobs is None:
+        n_jobs = 1
+    elif n_jobs < 0:
+        n_jobs = max(os.cpu_count() + 1 + n_jobs, 1)
+    thresholds = list(thresholds)
+    n_jobs = max(min(n_jobs, len(thresholds)), 1)
+    if n_jobs == 1:
+        true_discovery_proportions = _sweep_thresholds(
+            ari, p_vals, thresholds, adjacency)
+    else:
+        # interleave thresholds so each worker gets a similar mix of
+        # lenient (big clusters) and stringent (small clusters) thresholds
+        with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+            partial_tdps = pool.map(
+                lambda thres: _sweep_thresholds(ari, p_vals, thres, adjacency),
+                [thresholds[i::n_jobs] for i in range(n_jobs)]
+                )
+            true_discovery_proportions = reduce(np.maximum, partial_tdps)
 
     # get clusters where true discovery proportion exceeds threshold
-    clusters, _ = _find_clusters(true_discovery_proportions.flatten(), 1 - alpha, 1, adjacency)
-    if clusters:
-        clusters = _cluster_indices_to_mask(clusters, n_tests)
-        clusters = _reshape_clusters(clusters, true_discovery_proportions.shape)
+    clusters = _find_clusters(true_discovery_proportions.flatten(), 1 - alpha, 1, adjacency)
+    clusters = [c.reshape(true_discovery_proportions.shape) for c in clusters]
     return p_vals, true_discovery_proportions, clusters
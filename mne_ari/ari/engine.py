@@ -0,0 +1,589 @@
+from scipy.stats import t as t_dist
+from ..permutation import (
+    _check_random_state,
+    _chunk_slices,
+    _get_chunk,
+    _counts_to_p
+    )
+import numpy as np
+import pickle
+import shutil
+import os
+
+'''
+This module provides a single permutation engine shared by parametric and
+permutation-based ARI. One pass over the sign flips (one-sample tests) or
+shuffles (independent sample tests) produces everything either flavour needs:
+
+    - exceedance counts of the mean (difference), from which parametric ARI
+      gets its permutation p-values
+    - the observed p-values of the t-test (or a custom statfun)
+    - the calibration statistic of permutation-based ARI for each permutation
+
+so running both flavours of ARI on the same data only costs one permutation
+pass. Permutations are processed in blocks, and tests in chunks, so neither
+the full permutation distribution nor (with chunk_size) the full dataset
+needs to be held in memory at once.
+
+Since exceedance counts add up and calibration statistics concatenate across
+permutations, runs can be checkpointed to disk and resumed, and independent
+shards (run with different seeds) can be merged with merge_engines.
+
+For one-sample tests, the engine can also keep the per-permutation sums of
+the sign-flipped data (sum of squares doesn't depend on the flips), so new
+observations can be added with add_observations in O(n_perm x n_tests) time
+instead of rerunning all permutations from scratch. These are saved as .npy
+files next to the checkpoint, one per block, so each checkpoint only writes
+the blocks run since the last one.
+'''
+
+def _check_tail(tail):
+    if tail == 0 or tail == 'two-sided':
+        return 0
+    elif tail == 1 or tail == 'greater':
+        return 1
+    elif tail == -1 or tail == 'less':
+        return -1
+    else:
+        raise ValueError('Invalid input value for tail!')
+
+def _t_to_p(t, df, tail):
+    if tail == 1:
+        return t_dist.sf(t, df)
+    elif tail == -1:
+        return t_dist.cdf(t, df)
+    else:
+        return 2 * t_dist.sf(np.abs(t), df)
+
+def _1samp_stats(sums, sumsq, n, tail):
+    '''
+    computes the mean and one-sample t-test p-values from the sufficient
+    statistics of sign-flipped data, returning (n_perm, n_tests) and
+    (n_tests, n_perm) arrays respectively
+    '''
+    effect = sums / n
+    ss = sumsq - sums**2 / n
+    se = np.sqrt(np.maximum(ss, 0) / (n - 1) / n)
+    return effect, _t_to_p(effect / se, n - 1, tail).T
+
+def _lambda_stat(p, alpha, delta = 0):
+    '''
+    computes the pARI calibration statistic (for the Simes family) of each
+    permutation, given an (n_tests, n_perm) array of p-values
+
+    based on https://github.com/angeella/pARI/blob/master/src/lambdaCalibrate.cpp
+    '''
+    mm = p.shape[0] # number of tests
+    idV = np.arange(1 + delta, 1 + mm)
+    Y = np.sort(p, axis = 0) # sort p-values within each permutation
+    lam = (mm - delta) * Y[delta:mm] / ((idV - delta) * alpha)[:, np.newaxis]
+    return lam.min(axis = 0) # minimum over hypotheses
+
+
+class PermutationEngine:
+    '''
+    Runs the permutations for both parametric and permutation-based ARI in
+    a single pass. Pass the resulting object as X to ARI, pARI,
+    or all_resolutions_inference to reuse the same permutations.
+
+    Parameters
+    ----------
+        X: (n_observation, ...) array for one-sample/paired test
+            or a list of two such arrays for independent sample test
+        alpha: (float) the false discovery control level used to calibrate
+            permutation-based ARI
+        tail: 1 or 'greater', 0 or 'two-sided', -1 or 'less'
+        n_permutations: (int) number of permutations to perform
+        seed: None, int, or RandomState, seed for the random flips/shuffles
+        statfun: a custom statistics function to compute p-values, as in
+            all_resolutions_inference
+        shift: (float) shift for candidate critical vector family
+            of permutation-based ARI
+        chunk_size: (int) optional, number of tests to process at a time.
+            Without calibrate, each chunk is read once and the pre-drawn
+            flips/shuffles are replayed for it, as in permutation_test. The
+            calibration needs every test for each permutation, so with
+            calibrate the data are read once per block of permutations
+            (i.e. n_permutations / block_size passes over the data).
+        block_size: (int) number of permutations to process at a time.
+            The p-values of one block of permutations are held in memory.
+        checkpoint: (str) optional, file to save the permutation state to
+            every checkpoint_every permutations and at the end of the run.
+            If the file already exists, the run resumes from the saved
+            state, so n_permutations is the total number of permutations
+            including those already completed.
+        checkpoint_every: (int) number of permutations between checkpoints.
+            Without calibrate and with chunk_size, the data are read once
+            per checkpoint_every permutations. Default is 1000.
+        incremental: (bool) if True, keep the sign flips and per-permutation
+            sums so that observations (e.g. new subjects) can later be added
+            with add_observations. One-sample tests without statfun only.
+            Uses n_permutations x n_tests memory. Default is False.
+        calibrate: (bool) if True (default), also compute the permutation
+            p-values and calibration statistics needed by pARI. If False,
+            only the exceedance counts needed by (parametric) ARI are
+            computed, which is much faster.
+    '''
+
+    def __init__(self, X, alpha = .05, tail = 0, n_permutations = 10000,
+        seed = None, statfun = None, shift = 0, chunk_size = None,
+        block_size = 128, checkpoint = None, checkpoint_every = 1000,
+        incremental = False, calibrate = True):
+
+        self.alpha = alpha
+        self.tail = _check_tail(tail)
+        assert(shift >= 0)
+        self.delta = shift
+        self.statfun = statfun
+        self.custom_statfun = statfun is not None
+        self.calibrate = calibrate
+        self.chunk_size = chunk_size
+        if block_size < 1:
+            raise ValueError("block_size must be a positive integer.")
+        self.block_size = block_size
+        if checkpoint_every < 1:
+            raise ValueError("checkpoint_every must be a positive integer.")
+        self.checkpoint_every = checkpoint_every
+
+        if type(X) in [list, tuple]:
+            if len(X) != 2 and (statfun is None or n_permutations > 0):
+                raise ValueError("X list must be of length 2 " +
+                    "for independent sample permutations.")
+            self.independent = True
+            self.sample_shape = X[0][0].shape
+            self.n_obs = [x.shape[0] for x in X]
+        else:
+            self.independent = False
+            self.sample_shape = X[0].shape
+            self.n_obs = X.shape[0]
+        self.n_tests = int(np.prod(self.sample_shape))
+        if self.independent:
+            self._idxs = np.arange(sum(self.n_obs))
+        else:
+            self._idxs = None
+        self._X = X
+        self._cache = None
+        self.incremental = incremental
+        if incremental and (self.independent or statfun is not None):
+            raise ValueError("Incremental mode is only available for " +
+                "one-sample tests without a custom statfun.")
+
+        # observed statistics
+        self.effect = np.zeros(self.n_tests)
+        self.p_obs = np.empty(self.n_tests)
+        for chunk, X_chunk in self._iter_chunks():
+            if self.independent and len(X) != 2: # statfun only
+                self.p_obs[chunk] = statfun(X_chunk)
+                continue
+            effect, p = self._block_stats(X_chunk, self._identity())
+            self.effect[chunk] = effect[0]
+            self.p_obs[chunk] = p[:, 0]
+        if incremental:
+            self._sum_obs = self.effect * self.n_obs
+            self._sumsq = np.zeros(self.n_tests)
+            for chunk, X_chunk in self._iter_chunks():
+                self._sumsq[chunk] = (X_chunk**2).sum(0)
+            # sign flips and per-permutation sums, one entry per block
+            self._flips = []
+            self._sums = []
+            # (file name, n_obs, n_blocks) of the blocks saved to disk
+            self._saved = None
+        self.T_obs = _lambda_stat(self.p_obs[:, np.newaxis], alpha, shift)[0]
+
+        # permutation statistics
+        self.greater_ct = np.zeros(self.n_tests)
+        self.lesser_ct = np.zeros(self.n_tests)
+        self.T = np.empty(0)
+        self.n_permutations = 0
+        self._rng = _check_random_state(seed)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._resume(checkpoint)
+        self._run(n_permutations - self.n_permutations, checkpoint)
+        self._X = None
+        self._cache = None
+
+    def _identity(self):
+        '''
+        the design (sign flips or group assignment) of the observed data
+        '''
+        if self.independent:
+            return np.arange(sum(self.n_obs))[np.newaxis]
+        else:
+            return np.ones((1, self.n_obs))
+
+    def _draw(self, n):
+        '''
+        draws the sign flips or shuffles for the next n permutations
+        '''
+        if self.independent:
+            perms = np.empty((n, self._idxs.size), dtype = int)
+            for i in range(n):
+                self._rng.shuffle(self._idxs)
+                perms[i] = self._idxs
+            return perms
+        else:
+            return self._rng.choice([-1, 1], size = (n, self.n_obs))
+
+    def _iter_chunks(self):
+        '''
+        yields (chunk, X_chunk) pairs; if all tests fit in one chunk,
+        the data is only loaded into memory once
+
+        chunks are cast to float64, since the t-tests are computed from sums
+        (of squares) that lose too much precision in e.g. float32
+        '''
+        if self._cache is not None:
+            yield from self._cache
+            return
+        chunks = _chunk_slices(self.n_tests, self.chunk_size)
+        loaded = []
+        for chunk in chunks:
+            if self.independent:
+                X_chunk = [_get_chunk(x, chunk).astype(np.float64)
+                    for x in self._X]
+                if len(X_chunk) == 2:
+                    X_chunk = np.concatenate(X_chunk, axis = 0)
+            else:
+                X_chunk = _get_chunk(self._X, chunk).astype(np.float64)
+            if len(chunks) == 1:
+                loaded.append((chunk, X_chunk))
+            yield chunk, X_chunk
+        if len(chunks) == 1:
+            self._cache = loaded
+
+    def _block_stats(self, X_chunk, design, return_p = True):
+        '''
+        computes the mean (difference) and p-values of a chunk of tests for
+        a block of permutations, returning (n_perm, n_tests_in_chunk) and
+        (n_tests_in_chunk, n_perm) arrays respectively
+
+        if not return_p, only the mean (difference) is computed
+        and p is None
+        '''
+        if self.independent:
+            n1, n2 = self.n_obs
+            X_raw = X_chunk
+            # the test is invariant to shifting both groups, and centering
+            # avoids cancellation in the sums of squares
+            X_chunk = X_chunk - X_chunk.mean(0)
+            groups = np.zeros(design.shape, dtype = bool)
+            np.put_along_axis(groups, design[:, :n1], True, axis = 1)
+            groups = groups.astype(X_chunk.dtype)
+            sum1 = groups @ X_chunk
+            sum2 = X_chunk.sum(0) - sum1
+            effect = sum1 / n1 - sum2 / n2
+            if not return_p:
+                p = None
+            elif self.statfun is None:
+                sumsq1 = groups @ X_chunk**2
+                sumsq2 = (X_chunk**2).sum(0) - sumsq1
+                ss = (sumsq1 - sum1**2 / n1) + (sumsq2 - sum2**2 / n2)
+                df = n1 + n2 - 2
+                se = np.sqrt(np.maximum(ss, 0) / df * (1 / n1 + 1 / n2))
+                p = _t_to_p(effect / se, df, self.tail).T
+            else:
+                p = np.stack([
+                    self.statfun([X_raw[perm[:n1]], X_raw[perm[n1:]]])
+                    for perm in design
+                    ], axis = 1)
+        else:
+            sums = design @ X_chunk
+            if not return_p:
+                effect, p = sums / self.n_obs, None
+            elif self.statfun is None:
+                effect, p = _1samp_stats(sums, (X_chunk**2).sum(0),
+                    self.n_obs, self.tail)
+            else:
+                effect = sums / self.n_obs
+                p = np.stack([
+                    self.statfun(flips[:, np.newaxis] * X_chunk)
+                    for flips in design
+                    ], axis = 1)
+        return effect, p
+
+    def _run(self, n_permutations, checkpoint = None):
+        '''
+        runs n_permutations more permutations, saving the permutation state
+        every checkpoint_every permutations and at the end if requested
+        '''
+        if checkpoint is None:
+            round_size = max(n_permutations, 1)
+        else:
+            round_size = self.checkpoint_every
+        multiple_chunks = len(_chunk_slices(self.n_tests, self.chunk_size)) > 1
+        for start in range(0, n_permutations, round_size):
+            n = min(round_size, n_permutations - start)
+            if not self.calibrate and multiple_chunks:
+                self._run_chunks(n)
+            else:
+                self._run_blocks(n)
+            if checkpoint is not None:
+                self.save(checkpoint)
+
+    def _run_blocks(self, n_permutations):
+        '''
+        runs n_permutations more permutations, one block at a time
+        '''
+        for start in range(0, n_permutations, self.block_size):
+            n = min(self.block_size, n_permutations - start)
+            design = self._draw(n)
+            if self.calibrate:
+                p_block = np.empty((self.n_tests, n))
+            if self.incremental:
+                self._flips.append(design.astype(np.int8))
+                self._sums.append(np.empty((n, self.n_tests)))
+            for chunk, X_chunk in self._iter_chunks():
+                effect, p = self._block_stats(X_chunk, design, self.calibrate)
+                self._count(chunk, effect)
+                if self.calibrate:
+                    p_block[chunk] = p
+                if self.incremental:
+                    self._sums[-1][:, chunk] = effect * self.n_obs
+            if self.calibrate:
+                self.T = np.concatenate([self.T,
+                    _lambda_stat(p_block, self.alpha, self.delta)])
+            self.n_permutations += n
+
+    def _run_chunks(self, n_permutations):
+        '''
+        runs n_permutations more permutations without calibration, drawing
+        all the flips/shuffles up front and replaying them for each chunk of
+        tests, so each chunk is only read once
+        '''
+        sizes = [min(self.block_size, n_permutations - start)
+            for start in range(0, n_permutations, self.block_size)]
+        designs = [self._draw(n) for n in sizes]
+        if self.incremental:
+            self._flips += [design.astype(np.int8) for design in designs]
+            sums = [np.empty((n, self.n_tests)) for n in sizes]
+            self._sums += sums
+        for chunk, X_chunk in self._iter_chunks():
+            for i, design in enumerate(designs):
+                effect, _ = self._block_stats(X_chunk, design, False)
+                self._count(chunk, effect)
+                if self.incremental:
+                    sums[i][:, chunk] = effect * self.n_obs
+        self.n_permutations += n_permutations
+
+    def _count(self, chunk, effect):
+        '''
+        adds a block of permuted effects to the exceedance counts
+        '''
+        self.greater_ct[chunk] += (effect >= self.effect[chunk]).sum(0)
+        self.lesser_ct[chunk] += (effect <= self.effect[chunk]).sum(0)
+
+    def _check_compatible(self, other):
+        '''
+        makes sure the permutations in two engines are of the same test
+        on the same data, so they can be combined
+        '''
+        for attr in ['sample_shape', 'n_obs', 'alpha', 'tail', 'delta',
+                'independent', 'custom_statfun', 'incremental', 'calibrate']:
+            if getattr(self, attr) != getattr(other, attr):
+                raise ValueError("Cannot combine permutations with " +
+                    "different %s."%attr)
+        if not np.allclose(self.p_obs, other.p_obs, equal_nan = True):
+            raise ValueError("Cannot combine permutations of different data.")
+
+    def _resume(self, fname):
+        '''
+        picks up the permutation state where a checkpointed run left off
+        '''
+        saved = PermutationEngine.load(fname)
+        if saved._rng is None:
+            raise ValueError("%s holds permutations merged from several " % fname +
+                "shards, which can't be resumed. Run another shard with a " +
+                "different seed and merge it in instead.")
+        self._check_compatible(saved)
+        attrs = ['greater_ct', 'lesser_ct', 'T', 'n_permutations',
+            '_rng', '_idxs']
+        if self.incremental:
+            attrs += ['_flips', '_sums', '_saved']
+        for attr in attrs:
+            setattr(self, attr, getattr(saved, attr))
+
+    def add_observations(self, X_new, checkpoint = None):
+        '''
+        adds new observations (e.g. subjects) to an incremental one-sample
+        engine, drawing sign flips for them in every existing permutation
+        and updating the per-permutation sums rather than rerunning
+        the permutations. The result is the same as running the permutations
+        on all of the data with the extended flip matrix.
+
+        Parameters
+        ----------
+            X_new: (n_new_observations, ...) array with the same sample
+                shape as the original data
+            checkpoint: (str) optional, file to save the updated permutation
+                state to. An engine resumed from this checkpoint must then be
+                given all of the data, including the new observations.
+
+        To update ARI results, pass the engine to ARI, pARI,
+        or all_resolutions_inference again.
+        '''
+        if not self.incremental:
+            raise ValueError("Observations can only be added to a " +
+                "PermutationEngine created with incremental = True.")
+        if X_new[0].shape != self.sample_shape:
+            raise ValueError("New observations must have the same " +
+                "sample shape as the original data.")
+        X_new = np.reshape(X_new, (X_new.shape[0], -1)).astype(np.float64)
+        self.n_obs += X_new.shape[0]
+        n = self.n_obs
+
+        # observed statistics
+        self._sum_obs += (np.ones((1, X_new.shape[0])) @ X_new)[0]
+        self._sumsq += (X_new**2).sum(0)
+        effect, p = _1samp_stats(self._sum_obs[np.newaxis], self._sumsq,
+            n, self.tail)
+        self.effect = effect[0]
+        self.p_obs = p[:, 0]
+        self.T_obs = _lambda_stat(p, self.alpha, self.delta)[0]
+
+        # permutation statistics
+        self.greater_ct = np.zeros(self.n_tests)
+        self.lesser_ct = np.zeros(self.n_tests)
+        T = []
+        for i, sums in enumerate(self._sums):
+            flips = self._rng.choice([-1, 1], size = (len(sums), X_new.shape[0]))
+            self._flips[i] = np.concatenate(
+                [self._flips[i], flips.astype(np.int8)], axis = 1)
+            sums += flips @ X_new
+            effect, p = _1samp_stats(sums, self._sumsq, n, self.tail)
+            self._count(slice(None), effect)
+            if self.calibrate:
+                T.append(_lambda_stat(p, self.alpha, self.delta))
+        self.T = np.concatenate([np.empty(0)] + T)
+        if checkpoint is not None:
+            self.save(checkpoint)
+
+    def _save_blocks(self, fname):
+        '''
+        writes the flips and sums of an incremental engine to fname.blocks,
+        skipping the blocks already written there
+        '''
+        fname = os.path.abspath(fname)
+        block_dir = _block_dir(fname, self.n_obs)
+        if self._saved is not None and self._saved[:2] == (fname, self.n_obs):
+            start = self._saved[2]
+        else: # new file or new observations, so (re)write all blocks
+            start = 0
+            os.makedirs(block_dir, exist_ok = True)
+        for i in range(start, len(self._sums)):
+            np.save(os.path.join(block_dir, 'flips_%d.npy' % i), self._flips[i])
+            np.save(os.path.join(block_dir, 'sums_%d.npy' % i), self._sums[i])
+        self._saved = (fname, self.n_obs, len(self._sums))
+
+    def save(self, fname):
+        '''
+        saves the permutation state (but not the data or statfun) to disk
+        '''
+        if self.incremental:
+            self._save_blocks(fname)
+        state = self.__dict__.copy()
+        for attr in ['_X', '_cache', 'statfun']:
+            state[attr] = None
+        if self.incremental: # saved separately by _save_blocks
+            state['_flips'] = None
+            state['_sums'] = None
+        # write to a temporary file first, so a run killed mid-write
+        # doesn't corrupt the last checkpoint
+        tmp_fname = str(fname) + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp_fname, fname)
+        if self.incremental: # blocks for fewer observations are now stale
+            _remove_stale_blocks(fname, self.n_obs)
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        loads a PermutationEngine saved with PermutationEngine.save, which
+        can be passed to ARI/pARI or combined with others using merge_engines
+        '''
+        with open(fname, 'rb') as f:
+            state = pickle.load(f)
+        engine = cls.__new__(cls)
+        engine.__dict__.update(state)
+        if engine.incremental and engine._sums is None:
+            block_dir = _block_dir(fname, engine.n_obs)
+            n_blocks = engine._saved[2]
+            engine._flips = [np.load(os.path.join(block_dir,
+                'flips_%d.npy' % i)) for i in range(n_blocks)]
+            engine._sums = [np.load(os.path.join(block_dir,
+                'sums_%d.npy' % i)) for i in range(n_blocks)]
+            engine._saved = (os.path.abspath(fname), engine.n_obs, n_blocks)
+        return engine
+
+    @property
+    def permutation_p_values(self):
+        '''
+        (flattened) p-values of the permutation test on the mean (difference)
+        '''
+        return _counts_to_p(self.greater_ct, self.lesser_ct,
+            self.n_permutations, self.tail)
+
+
+def _block_dir(fname, n_obs):
+    '''
+    directory the blocks of an incremental engine with n_obs observations
+    are saved to
+    '''
+    return os.path.join(str(fname) + '.blocks', str(n_obs))
+
+def _remove_stale_blocks(fname, n_obs):
+    '''
+    removes blocks saved for other numbers of observations
+    '''
+    blocks_dir = str(fname) + '.blocks'
+    for d in os.listdir(blocks_dir):
+        if d != str(n_obs):
+            shutil.rmtree(os.path.join(blocks_dir, d))
+
+def _same_permutations(a, b):
+    '''
+    checks whether two shards look like they ran the same permutations
+    '''
+    if a.calibrate:
+        return np.array_equal(a.T, b.T)
+    return a.n_permutations == b.n_permutations and \
+        np.array_equal(a.greater_ct, b.greater_ct) and \
+        np.array_equal(a.lesser_ct, b.lesser_ct)
+
+def merge_engines(engines):
+    '''
+    combines independent permutation runs (shards) of the same test on the
+    same data into one PermutationEngine, as if all of their permutations
+    had been run at once. Shards must be run with different seeds.
+
+    Parameters
+    ----------
+        engines: list of PermutationEngine objects, or of file names to load
+            them from (as saved by PermutationEngine.save or a checkpoint)
+
+    Returns
+    ----------
+        engine: a PermutationEngine with the merged permutations
+    '''
+    engines = [PermutationEngine.load(e) if isinstance(e, (str, os.PathLike))
+        else e for e in engines]
+    if len(engines) == 0:
+        raise ValueError("Need at least one PermutationEngine to merge.")
+    merged = PermutationEngine.__new__(PermutationEngine)
+    merged.__dict__.update(engines[0].__dict__)
+    for i, other in enumerate(engines[1:], 1):
+        merged._check_compatible(other)
+        if other.n_permutations > 0 and any(_same_permutations(other, e)
+            for e in engines[:i]):
+            raise ValueError("Shards appear to contain the same " +
+                "permutations. Did you use the same seed for each shard?")
+    merged.greater_ct = np.sum([e.greater_ct for e in engines], axis = 0)
+    merged.lesser_ct = np.sum([e.lesser_ct for e in engines], axis = 0)
+    merged.T = np.concatenate([e.T for e in engines])
+    merged.n_permutations = sum(e.n_permutations for e in engines)
+    # merged permutations can't be extended, since no single RNG produced them
+    merged._rng = None
+    merged.incremental = False
+    merged._flips = None
+    merged._sums = None
+    return merged
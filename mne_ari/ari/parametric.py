@@ -1,5 +1,4 @@
-from ._permutation import _permutation_1samp, _permutation_ind
-from ..permutation import permutation_test
+from .engine import PermutationEngine
 import numpy as np
 
 def _compute_hommel_value(p_vals, alpha):
@@ -79,9 +78,15 @@ class ARI:
     '''
 
     def __init__(self, X, alpha, tail = 0,
-        n_permutations = 10000, seed = None, statfun = None):
+        n_permutations = 10000, seed = None, statfun = None, chunk_size = None):
         '''
         use permutation distribution to estimate best critical vector for later inference
+
+        if chunk_size is given, tests are processed chunk_size at a time, so
+        X may be a memory-mapped array that doesn't fit in memory
+
+        X can also be a PermutationEngine, in which case its permutations
+        are reused instead of running new ones
         '''
         if tail == 0 or tail == 'two-sided':
             self.alternative = 0
@@ -93,38 +98,27 @@ class ARI:
             raise ValueError('Invalid input value for tail!')
         self.alpha = alpha
 
-        if type(X) in [list, tuple]:
-            self.sample_shape = X[0][0].shape
-            X = [np.reshape(x, (x.shape[0], -1)) for x in X] # flatten samples
-            if statfun is None:
-                # we use our own permutation test rather than e.g. scipy's b/c
-                # those are slower and can give incorrect p-vals == 0 exactly
-                # if observed as greater/less than all random shuffles
-                try:
-                    assert(len(X) == 2)
-                except:
-                    raise ValueError("X list must be of length 2 " +
-                        " for default independent sample statfun")
-                p = permutation_test(
-                    X,
-                    n_permutations = n_permutations, tail = self.alternative,
-                    seed = seed
-                    )
-            else:
-                statfun_warning()
-                p = statfun(X)
+        if isinstance(X, PermutationEngine): # reuse existing permutations
+            engine = X
+            if engine.tail != self.alternative:
+                raise ValueError("tail must match the tail " +
+                    "the PermutationEngine was run with.")
+        else:
+            # with a custom statfun, p-values don't come from permutations
+            if statfun is not None:
+                n_permutations = 0
+            # we only need the exceedance counts, not pARI's calibration
+            engine = PermutationEngine(X, alpha, tail, n_permutations, seed,
+                statfun, chunk_size = chunk_size, calibrate = False)
+        self.sample_shape = engine.sample_shape
+        if not engine.custom_statfun:
+            # we use our own permutation test rather than e.g. scipy's b/c
+            # those are slower and can give incorrect p-vals == 0 exactly
+            # if observed as greater/less than all random shuffles
+            p = engine.permutation_p_values
         else:
-            self.sample_shape = X[0].shape
-            X = np.reshape(X, (X.shape[0], -1)) # flatten samples
-            if statfun is None:
-                p = permutation_test(
-                    X,
-                    n_permutations = n_permutations, tail = self.alternative,
-                    seed = seed
-                    )
-            else:
-                statfun_warning()
-                p = statfun(X)
+            statfun_warning()
+            p = engine.p_obs
 
         # ARI can output TDP > 1 if p == 0, neither of which make sense
         if np.any(p == 0):
@@ -1,27 +1,16 @@
-from ._permutation import _permutation_1samp, _permutation_ind
+from .engine import PermutationEngine, _check_tail
 import numpy as np
 
-def _optimize_lambda(p, alpha, delta = 0):
+def _optimize_lambda(T, alpha):
     '''
-    finds best lambda parameter given the permutation distribution of p-values
+    finds best lambda parameter given the permutation distribution of the
+    calibration statistic T (observed data included), as computed by
+    PermutationEngine
 
     based on https://github.com/angeella/pARI/blob/master/src/lambdaCalibrate.cpp
     but only supports Simes family 
     '''
-    b = p.shape[1] # number of permutations 
-    mm = p.shape[0] # number of tests
-    T = np.empty(b)
-    idV = np.arange(1 + delta, 1 + mm)
-    deltaV = np.full(mm - delta, delta)
-    mV = np.full(mm - delta, mm)
-
-    ## sort columns of p-vals
-    Y = np.sort(p, axis = 1)
-
-    # compute lambda for each permutation
-    for bb in range(b):
-        lam = (mV - deltaV) % Y[delta:mm, bb] / ((idV - deltaV) * alpha)
-        T[bb] = np.min(lam) # minimum over hypotheses
+    b = T.shape[0] # number of permutations 
     T = np.sort(T)
     idx = np.floor(alpha * b).astype(int)
     return T[idx]
@@ -47,9 +36,18 @@ class pARI:
     '''
 
     def __init__(self, X, alpha, tail = 0, 
-        n_permutations = 10000, seed = None, statfun = None, shift = 0):
+        n_permutations = 10000, seed = None, statfun = None, shift = 0,
+        chunk_size = None):
         '''
         uses permutation distribution to estimate best critical vector
+
+        X can also be a PermutationEngine, in which case its permutations
+        are reused instead of running new ones
+
+        if chunk_size is given, tests are processed chunk_size at a time, so
+        X may be a memory-mapped array that doesn't fit in memory. Since the
+        calibration needs every test for each permutation, the data are then
+        read once per block of permutations (see PermutationEngine)
         '''
         if tail == 0 or tail == 'two-sided':
             self.alternative = 'two-sided'
@@ -63,18 +61,24 @@ class pARI:
         assert(shift >= 0)
         self.delta = shift # same default as pARIBrain, see [1] 
 
-        if type(X) in [list, tuple]:
-            self.sample_shape = X[0][0].shape 
-            X = [np.reshape(x, (x.shape[0], -1)) for x in X] # flatten samples
-            p = _permutation_ind(X, n_permutations, self.alternative, seed, statfun)
+        if isinstance(X, PermutationEngine): # reuse existing permutations
+            engine = X
+            if (engine.alpha != alpha or engine.delta != shift
+                    or engine.tail != _check_tail(tail)):
+                raise ValueError("alpha, tail, and shift must match those " +
+                    "the PermutationEngine was run with.")
+            if not engine.calibrate:
+                raise ValueError("pARI needs a PermutationEngine " +
+                    "run with calibrate = True.")
         else:
-            self.sample_shape = X[0].shape
-            X = np.reshape(X, (X.shape[0], -1)) # flatten samples
-            p = _permutation_1samp(X, n_permutations, self.alternative, seed, statfun)
+            engine = PermutationEngine(X, alpha, tail, n_permutations, seed,
+                statfun, shift, chunk_size)
+        self.sample_shape = engine.sample_shape
 
-        self.p = p[:, 0] # just the observed values 
-        self.lam = _optimize_lambda(p, self.alpha, self.delta)
-        self.crit_vec = _get_critical_vector(p, self.alpha, self.lam, self.delta)
+        self.p = engine.p_obs # just the observed values 
+        T = np.concatenate([[engine.T_obs], engine.T])
+        self.lam = _optimize_lambda(T, self.alpha)
+        self.crit_vec = _get_critical_vector(self.p, self.alpha, self.lam, self.delta)
 
     def true_discovery_proportion(self, mask):
         '''
@@ -0,0 +1,46 @@
+from .._clusters import _find_clusters, _setup_adjacency
+from mne.stats.cluster_level import _find_clusters as mne_find_clusters
+from mne.stats.cluster_level import _setup_adjacency as mne_setup_adjacency
+from mne.stats.cluster_level import _cluster_indices_to_mask
+from mne.stats import combine_adjacency
+
+from scipy import sparse
+import numpy as np
+
+def _as_sets(clusters):
+    return set(tuple(np.flatnonzero(c)) for c in clusters)
+
+def _test_clusters(x, threshold, tail, adjacency = None):
+    '''
+    verify that we get the same clusters as MNE's implementation
+    '''
+    n_tests = x.size
+    if adjacency is None:
+        clusters = _find_clusters(x, threshold, tail)
+        mne_clusters, _ = mne_find_clusters(x, threshold, tail)
+    else:
+        adj = _setup_adjacency(adjacency, n_tests, x.shape[0])
+        clusters = _find_clusters(x.flatten(), threshold, tail, adj)
+        adj = mne_setup_adjacency(adjacency, n_tests, x.shape[0])
+        mne_clusters, _ = mne_find_clusters(x.flatten(), threshold, tail, adj)
+    mne_clusters = _cluster_indices_to_mask(mne_clusters, n_tests)
+    for c in clusters:
+        assert(c.shape == x.shape or c.shape == (n_tests,))
+    assert(_as_sets(clusters) == _as_sets(mne_clusters))
+
+def test_clusters():
+    np.random.seed(0)
+    n_times, n_chans = 20, 15
+    # random spatial adjacency between channels
+    chan_adj = sparse.random(n_chans, n_chans, density = .2, format = 'csr')
+    chan_adj = ((chan_adj + chan_adj.T) > 0).astype(float)
+    for threshold in (.01, .05, .2, .5):
+        for tail in (-1, 1):
+            if tail == 1:
+                threshold = 1 - threshold
+            _test_clusters(np.random.uniform(size = n_times), threshold, tail)
+            x = np.random.uniform(size = (n_times, n_chans))
+            _test_clusters(x, threshold, tail) # lattice
+            _test_clusters(x, threshold, tail, chan_adj) # spatio-temporal
+            adj = combine_adjacency(n_times, chan_adj) # full adjacency
+            _test_clusters(x, threshold, tail, adj)
@@ -0,0 +1,279 @@
+from ..engine import PermutationEngine, merge_engines, _lambda_stat
+from ..ari import all_resolutions_inference
+from ..parametric import ARI
+from ..permutation import pARI, _optimize_lambda
+from ...permutation import permutation_test, _get_chunk
+from .. import engine as engine_module
+
+from numpy.testing import assert_allclose
+from scipy.stats import ttest_1samp, ttest_ind
+import numpy as np
+import pickle
+import pytest
+import os
+
+N_PERM = 200
+
+def _test_engine(X, tail):
+    '''
+    make sure the shared permutation engine gives the same statistics
+    as scipy and our standalone permutation test
+    '''
+    alternative = {0: 'two-sided', 1: 'greater', -1: 'less'}[tail]
+    engine = PermutationEngine(X, tail = tail,
+        n_permutations = N_PERM, seed = 0)
+    if type(X) is list:
+        _, p = ttest_ind(X[0], X[1], axis = 0, alternative = alternative)
+    else:
+        _, p = ttest_1samp(X, 0, axis = 0, alternative = alternative)
+    assert_allclose(engine.p_obs, p.flatten())
+    p = permutation_test(X, tail = tail, n_permutations = N_PERM, seed = 0)
+    assert_allclose(engine.permutation_p_values, p.flatten())
+    assert(engine.T.shape == (N_PERM,))
+    # results shouldn't depend on how work is split up
+    chunked = PermutationEngine(X, tail = tail, n_permutations = N_PERM,
+        seed = 0, chunk_size = 17, block_size = 30)
+    assert_allclose(chunked.p_obs, engine.p_obs)
+    assert_allclose(chunked.permutation_p_values, engine.permutation_p_values)
+    assert_allclose(chunked.T, engine.T)
+
+def test_engine():
+    np.random.seed(0)
+    data1 = np.random.normal(size = [30, 10, 12]) + .2
+    data2 = np.random.normal(size = [25, 10, 12])
+    for tail in (-1, 0, 1):
+        _test_engine(data1, tail)
+        _test_engine([data1, data2], tail)
+
+def test_engine_reuse():
+    '''
+    make sure both types of ARI give the same results from a shared
+    engine as they do when each runs its own permutations
+    '''
+    np.random.seed(0)
+    data = np.random.normal(size = [30, 10, 12])
+    data[:, :4, :4] += 1
+    engine = PermutationEngine(data, n_permutations = N_PERM, seed = 0)
+    for ari_type in ('parametric', 'permutation'):
+        p_vals, tdp, _ = all_resolutions_inference(data,
+            ari_type = ari_type, n_permutations = N_PERM, seed = 0)
+        p_vals_shared, tdp_shared, _ = all_resolutions_inference(engine,
+            ari_type = ari_type)
+        assert_allclose(p_vals, p_vals_shared)
+        assert_allclose(tdp, tdp_shared)
+
+def test_engine_checkpoint(tmp_path):
+    '''
+    make sure a run resumed from a checkpoint gives the same result as
+    an uninterrupted run, and that merged shards behave like one big run
+    '''
+    np.random.seed(0)
+    data1 = np.random.normal(size = [30, 10, 12])
+    data2 = np.random.normal(size = [25, 10, 12])
+    for X in (data1, [data1, data2]):
+        fname = tmp_path / 'checkpoint.pkl'
+        if fname.exists():
+            fname.unlink()
+        full = PermutationEngine(X, n_permutations = N_PERM, seed = 0,
+            block_size = 50)
+        # pretend we were killed after the first 100 permutations
+        PermutationEngine(X, n_permutations = 100, seed = 0,
+            block_size = 50, checkpoint = fname)
+        resumed = PermutationEngine(X, n_permutations = N_PERM, seed = 0,
+            block_size = 50, checkpoint = fname)
+        assert(resumed.n_permutations == N_PERM)
+        assert_allclose(resumed.greater_ct, full.greater_ct)
+        assert_allclose(resumed.lesser_ct, full.lesser_ct)
+        assert_allclose(resumed.T, full.T)
+
+        # combine shards run with different seeds
+        shard1 = PermutationEngine(X, n_permutations = 100, seed = 1)
+        shard1.save(tmp_path / 'shard1.pkl')
+        shard2 = PermutationEngine(X, n_permutations = 50, seed = 2)
+        merged = merge_engines([tmp_path / 'shard1.pkl', shard2])
+        assert(merged.n_permutations == 150)
+        assert_allclose(merged.greater_ct,
+            shard1.greater_ct + shard2.greater_ct)
+        assert_allclose(merged.T, np.concatenate([shard1.T, shard2.T]))
+        with pytest.raises(ValueError):
+            merge_engines([shard1, shard1])
+        ari = ARI(merged, alpha = .05)
+        pari = pARI(merged, alpha = .05)
+        assert(ari.p_values.shape == (10, 12))
+        assert(pari.p_values.shape == (10, 12))
+
+def test_engine_incremental():
+    '''
+    make sure adding observations to an incremental engine gives the same
+    result as computing the permutations on all the data at once
+    '''
+    np.random.seed(0)
+    data = np.random.normal(size = [30, 10, 12]) + .2
+    engine = PermutationEngine(data[:20], n_permutations = N_PERM,
+        seed = 0, block_size = 64, incremental = True)
+    first = PermutationEngine(data[:20], n_permutations = N_PERM,
+        seed = 0, block_size = 64)
+    assert_allclose(engine.T, first.T)
+    engine.add_observations(data[20:25])
+    engine.add_observations(data[25:])
+    assert(engine.n_obs == 30)
+    assert(engine.n_permutations == N_PERM)
+
+    _, p = ttest_1samp(data, 0, axis = 0)
+    assert_allclose(engine.p_obs, p.flatten())
+    # replay the (extended) sign flips on all the data
+    flips = np.concatenate(engine._flips, axis = 0)
+    assert(flips.shape == (N_PERM, 30))
+    full = PermutationEngine(data, n_permutations = 0)
+    effect, p = full._block_stats(np.reshape(data, (30, -1)), flips)
+    assert_allclose(engine.greater_ct, (effect >= full.effect).sum(0))
+    assert_allclose(engine.lesser_ct, (effect <= full.effect).sum(0))
+    assert_allclose(engine.T, _lambda_stat(p, engine.alpha))
+
+    with pytest.raises(ValueError):
+        first.add_observations(data[20:])
+
+def test_engine_incremental_checkpoint(tmp_path, monkeypatch):
+    '''
+    make sure each block of an incremental engine is only written to disk
+    once, and that checkpoints written after adding observations resume
+    '''
+    np.random.seed(0)
+    data = np.random.normal(size = [30, 10, 12]) + .2
+    fname = tmp_path / 'checkpoint.pkl'
+    n_saves = [0]
+    save = np.save
+    def _count_saves(*args, **kwargs):
+        n_saves[0] += 1
+        save(*args, **kwargs)
+    monkeypatch.setattr(np, 'save', _count_saves)
+    PermutationEngine(data[:20], n_permutations = 100, seed = 0,
+        block_size = 50, incremental = True, checkpoint = fname,
+        checkpoint_every = 50)
+    engine = PermutationEngine(data[:20], n_permutations = 300, seed = 0,
+        block_size = 50, incremental = True, checkpoint = fname,
+        checkpoint_every = 50)
+    assert(n_saves[0] == 2 * 6) # flips and sums of each block, once
+    monkeypatch.undo()
+    with open(fname, 'rb') as f:
+        assert(pickle.load(f)['_sums'] is None)
+    full = PermutationEngine(data[:20], n_permutations = 300, seed = 0,
+        block_size = 50, incremental = True)
+    assert_allclose(engine.greater_ct, full.greater_ct)
+    assert_allclose(np.concatenate(engine._sums),
+        np.concatenate(full._sums))
+
+    engine.add_observations(data[20:], checkpoint = fname)
+    assert(os.listdir(str(fname) + '.blocks') == ['30'])
+    with pytest.raises(ValueError): # checkpoint is for the extended data
+        PermutationEngine(data[:20], n_permutations = 400, seed = 0,
+            block_size = 50, incremental = True, checkpoint = fname)
+    resumed = PermutationEngine(data, n_permutations = 400, seed = 0,
+        block_size = 50, incremental = True, checkpoint = fname)
+    assert(resumed.n_permutations == 400)
+    flips = np.concatenate(resumed._flips, axis = 0)
+    assert_allclose(flips[:300], np.concatenate(engine._flips, axis = 0))
+    effect, p = resumed._block_stats(np.reshape(data, (30, -1)), flips)
+    assert_allclose(resumed.greater_ct, (effect >= resumed.effect).sum(0))
+    assert_allclose(resumed.T, _lambda_stat(p, resumed.alpha))
+
+def test_engine_no_calibration(monkeypatch):
+    '''
+    make sure skipping pARI's calibration gives the same exceedance counts,
+    and that each chunk of the data is then only read once per pass
+    '''
+    np.random.seed(0)
+    data1 = np.random.normal(size = [30, 10, 12])
+    data2 = np.random.normal(size = [25, 10, 12])
+    for X in (data1, [data1, data2]):
+        engine = PermutationEngine(X, n_permutations = N_PERM, seed = 0)
+        n_loads = [0]
+        def _count_loads(X, chunk):
+            n_loads[0] += 1
+            return _get_chunk(X, chunk)
+        monkeypatch.setattr(engine_module, '_get_chunk', _count_loads)
+        fast = PermutationEngine(X, n_permutations = N_PERM, seed = 0,
+            chunk_size = 40, block_size = 30, calibrate = False)
+        monkeypatch.undo()
+        n_arrays = len(X) if type(X) is list else 1
+        # one pass for the observed data, one for the permutations
+        assert(n_loads[0] == 2 * 3 * n_arrays)
+        assert_allclose(fast.permutation_p_values, engine.permutation_p_values)
+        assert(fast.T.size == 0)
+        with pytest.raises(ValueError):
+            pARI(fast, alpha = .05)
+
+def test_engine_float32():
+    '''
+    make sure float32 data (e.g. memory-mapped epochs) with a large offset
+    don't lose precision in the t-tests
+    '''
+    np.random.seed(0)
+    data1 = (np.random.normal(size = [30, 10, 12]) + 100).astype(np.float32)
+    data2 = (np.random.normal(size = [25, 10, 12]) + 100).astype(np.float32)
+    engine = PermutationEngine([data1, data2], n_permutations = N_PERM)
+    _, p = ttest_ind(data1.astype(np.float64), data2.astype(np.float64),
+        axis = 0)
+    assert_allclose(engine.p_obs, p.flatten(), rtol = 1e-6)
+    engine = PermutationEngine(data1, n_permutations = N_PERM)
+    _, p = ttest_1samp(data1.astype(np.float64), 0, axis = 0)
+    assert(np.all(engine.p_obs > 0))
+    assert_allclose(engine.p_obs, p.flatten(), rtol = 1e-6)
+
+def test_lambda_calibration():
+    '''
+    check pARI's calibration against values computed by hand from the
+    Simes family in pARI's lambdaCalibrate.cpp, i.e. for each permutation
+    T = min_i (m - delta) * p_(i) / ((i - delta) * alpha) for i > delta
+    where p_(i) is the i-th smallest p-value of that permutation
+    '''
+    # 3 tests x 4 permutations
+    p = np.array([
+        [.01, .20, .90, .05],
+        [.04, .02, .60, .05],
+        [.50, .03, .30, .05]
+        ])
+    # alpha = .1: sorted columns give
+    # [.3, .6, 5], [.6, .45, 2], [9, 9, 9], [1.5, .75, .5]
+    assert_allclose(_lambda_stat(p, .1), [.3, .45, 9, .5])
+    # delta = 1 skips the smallest p-value: [.8, 5], [.6, 2], [12, 9], [1, .5]
+    assert_allclose(_lambda_stat(p, .1, delta = 1), [.8, .6, 9, .5])
+    # lambda is the floor(alpha * b)-th smallest T
+    T = np.array([.3, .45, 9, .5])
+    assert_allclose(_optimize_lambda(T, .1), .3) # floor(.4) = 0
+    assert_allclose(_optimize_lambda(T, .5), .5) # floor(2) = 2
+
+def test_engine_checkpoint_every(tmp_path, monkeypatch):
+    '''
+    make sure checkpoints are only written periodically and at the end,
+    and that merged shards can't be resumed
+    '''
+    np.random.seed(0)
+    data = np.random.normal(size = [30, 10, 12])
+    fname = tmp_path / 'checkpoint.pkl'
+    n_saves = [0]
+    save = PermutationEngine.save
+    def _count_saves(self, fname):
+        n_saves[0] += 1
+        save(self, fname)
+    monkeypatch.setattr(PermutationEngine, 'save', _count_saves)
+    for calibrate in (True, False):
+        n_saves[0] = 0
+        if fname.exists():
+            fname.unlink()
+        engine = PermutationEngine(data, n_permutations = 250, seed = 0,
+            block_size = 50, chunk_size = 40, checkpoint = fname,
+            checkpoint_every = 100, calibrate = calibrate)
+        assert(n_saves[0] == 3) # after 100, 200, and 250 permutations
+        full = PermutationEngine(data, n_permutations = 250, seed = 0,
+            block_size = 50, chunk_size = 40, calibrate = calibrate)
+        assert_allclose(engine.greater_ct, full.greater_ct)
+        assert_allclose(engine.T, full.T)
+    monkeypatch.undo()
+
+    shard = PermutationEngine(data, n_permutations = 50, seed = 1,
+        calibrate = False)
+    merge_engines([engine, shard]).save(fname)
+    with pytest.raises(ValueError):
+        PermutationEngine(data, n_permutations = 500, seed = 0,
+            checkpoint = fname, calibrate = False)
@@ -1,4 +1,3 @@
-from mne.utils import check_random_state
 from typing import Iterable
 import numpy as np 
 
@@ -11,9 +10,25 @@ all-resolutions inference. Hence, we provide our own implementations here.
 
 They're not the fastest permutation tests in the world with those for loops,
 but they're pretty memory efficient since they never hold the full permutation
-distribution in memory at once.
+distribution in memory at once. With the chunk_size option, they don't even
+hold the full dataset in memory at once, since the same flips/shuffles are
+replayed for each chunk of tests.
 '''
 
+def _check_random_state(seed):
+    '''
+    turns seed into a RandomState (or passes through a Generator), as in
+    mne.utils.check_random_state but without importing MNE
+    '''
+    if seed is None or seed is np.random:
+        return np.random.mtrand._rand
+    if isinstance(seed, (int, np.integer)):
+        return np.random.RandomState(seed)
+    if isinstance(seed, (np.random.RandomState, np.random.Generator)):
+        return seed
+    raise ValueError("%r cannot be used to seed a " % seed +
+        "numpy.random.RandomState instance")
+
 def _compare(obs, perm, tail):
     if tail == 1:
         mask = (perm >= obs)
@@ -21,19 +36,43 @@ def _compare(obs, perm, tail):
         mask = (perm <= obs)
     return mask
 
-def _permutation_test_1samp(X, n_permutations = 10000, tail = 0, seed = None):
-    rng = check_random_state(seed)
-    greater_ct = np.zeros_like(X[0])
-    lesser_ct = np.zeros_like(X[0])
-    obs = X.mean(0)
-    for i in range(n_permutations):
-        flips = rng.choice([-1, 1], size = X.shape[0])
-        broadcast_shape = [X.shape[0]] + (len(X.shape) - 1)*[1]
-        flips = np.reshape(flips, broadcast_shape)
-        perm_X = flips * X
-        perm_effect = perm_X.mean(0)
-        greater_ct += _compare(obs, perm_effect, 1)
-        lesser_ct += _compare(obs, perm_effect, -1)
+def _n_tests(X):
+    '''
+    number of tests (i.e. product of the sample shape) in an
+    (n_observations, ...) array
+    '''
+    return int(np.prod(X.shape[1:]))
+
+def _chunk_slices(n_tests, chunk_size = None):
+    '''
+    splits the (flattened) tests into contiguous chunks of at most chunk_size
+    '''
+    if chunk_size is None:
+        chunk_size = n_tests
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    return [slice(start, min(start + chunk_size, n_tests))
+            for start in range(0, n_tests, chunk_size)]
+
+def _get_chunk(X, chunk):
+    '''
+    loads a chunk of (flattened) tests from an (n_observations, ...) array
+    into memory as an (n_observations, n_tests_in_chunk) array.
+
+    Only the requested tests are read, so this works with memory-mapped
+    arrays (np.memmap) of any memory layout without copying the full dataset.
+    '''
+    n_obs = X.shape[0]
+    if X.ndim == 2:
+        X_chunk = X[:, chunk]
+    elif X.flags.c_contiguous: # flattening is just a view
+        X_chunk = np.reshape(X, (n_obs, -1))[:, chunk]
+    else: # avoid the full copy np.reshape would make
+        idxs = np.unravel_index(np.arange(chunk.start, chunk.stop), X.shape[1:])
+        X_chunk = X[(slice(None),) + idxs]
+    return np.ascontiguousarray(X_chunk)
+
+def _counts_to_p(greater_ct, lesser_ct, n_permutations, tail):
     if tail == 1:
         p = (greater_ct + 1) / (n_permutations + 1)
     elif tail == -1:
@@ -46,31 +85,48 @@ def _permutation_test_1samp(X, n_permutations = 10000, tail = 0, seed = None):
         raise ValueError("Cannot compute p-value with meaningless tail = %d."%tail)
     return p
 
-def _permutation_test_ind(X, n_permutations = 10000, tail = 0, seed = None):
-    rng = check_random_state(seed)
+def _permutation_test_1samp(X, n_permutations = 10000, tail = 0, seed = None,
+    chunk_size = None):
+    rng = _check_random_state(seed)
+    # draw all sign flips up front so the same flips can be replayed
+    # for every chunk of tests
+    flips = rng.choice([-1, 1], size = (n_permutations, X.shape[0]))
+    n_tests = _n_tests(X)
+    greater_ct = np.zeros(n_tests)
+    lesser_ct = np.zeros(n_tests)
+    for chunk in _chunk_slices(n_tests, chunk_size):
+        X_chunk = _get_chunk(X, chunk)
+        obs = X_chunk.mean(0)
+        for i in range(n_permutations):
+            perm_effect = (flips[i][:, np.newaxis] * X_chunk).mean(0)
+            greater_ct[chunk] += _compare(obs, perm_effect, 1)
+            lesser_ct[chunk] += _compare(obs, perm_effect, -1)
+    p = _counts_to_p(greater_ct, lesser_ct, n_permutations, tail)
+    return np.reshape(p, X.shape[1:])
+
+def _permutation_test_ind(X, n_permutations = 10000, tail = 0, seed = None,
+    chunk_size = None):
+    rng = _check_random_state(seed)
     n1 = len(X[0])
-    X = np.concatenate(X, axis = 0)
-    greater_ct = np.zeros_like(X[0])
-    lesser_ct = np.zeros_like(X[0])
-    idxs = np.arange(len(X))
-    obs = X[:n1].mean(0) - X[n1:].mean(0)
+    idxs = np.arange(n1 + len(X[1]))
+    # record the shuffles up front so they can be replayed for every chunk
+    perms = np.empty((n_permutations, idxs.size), dtype = int)
     for i in range(n_permutations):
         rng.shuffle(idxs)
-        perm_X = X[idxs]
-        perm_effect = perm_X[:n1].mean(0) - perm_X[n1:].mean(0)
-        greater_ct += _compare(obs, perm_effect, 1)
-        lesser_ct += _compare(obs, perm_effect, -1)
-    if tail == 1:
-        p = (greater_ct + 1) / (n_permutations + 1)
-    elif tail == -1:
-        p = (lesser_ct + 1) / (n_permutations + 1)
-    elif tail == 0:
-        p1 = (greater_ct + 1) / (n_permutations + 1)
-        p2 = (lesser_ct + 1) / (n_permutations + 1)
-        p = 2 * np.stack([p1, p2], 0).min(0)
-    else:
-        raise ValueError("Cannot compute p-value with meaningless tail = %d."%tail)
-    return p
+        perms[i] = idxs
+    n_tests = _n_tests(X[0])
+    greater_ct = np.zeros(n_tests)
+    lesser_ct = np.zeros(n_tests)
+    for chunk in _chunk_slices(n_tests, chunk_size):
+        X_chunk = np.concatenate([_get_chunk(x, chunk) for x in X], axis = 0)
+        obs = X_chunk[:n1].mean(0) - X_chunk[n1:].mean(0)
+        for i in range(n_permutations):
+            perm_X = X_chunk[perms[i]]
+            perm_effect = perm_X[:n1].mean(0) - perm_X[n1:].mean(0)
+            greater_ct[chunk] += _compare(obs, perm_effect, 1)
+            lesser_ct[chunk] += _compare(obs, perm_effect, -1)
+    p = _counts_to_p(greater_ct, lesser_ct, n_permutations, tail)
+    return np.reshape(p, X[0].shape[1:])
 
 
 def permutation_test(X, **kwargs):
@@ -87,6 +143,12 @@ def permutation_test(X, **kwargs):
         the alternative hypothesis is that the mean of the data is different
         than 0 (two tailed test).  If tail is -1, the alternative hypothesis
         is that the mean of the data is less than 0 (lower tailed test).
+    seed : None, int, or RandomState, seed for the random sign flips/shuffles.
+    chunk_size : None or int (default = None)
+        If given, the tests are processed in chunks of at most chunk_size
+        tests, replaying the same sign flips/shuffles for every chunk. Only one
+        chunk of X is loaded into memory at a time, so X can be a
+        memory-mapped array (e.g. np.memmap) larger than available memory.
     """
     if isinstance(X, list) or isinstance(X, tuple):
         assert(len(X) == 2)
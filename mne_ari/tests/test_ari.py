@@ -125,3 +125,20 @@ def test_ari():
 
 
 
+def test_ari_n_jobs():
+	'''
+	make sure splitting the threshold sweep across threads
+	gives the same result as a serial sweep
+	'''
+	np.random.seed(0)
+	data = np.random.normal(size = [30, 20, 15])
+	data[:, :5, :5] += 1
+	for ari_type in ('parametric', 'permutation'):
+		p_vals, tdp, clusters = all_resolutions_inference(
+			data, ari_type = ari_type, n_permutations = N_PERMS, seed = 0)
+		p_vals_par, tdp_par, clusters_par = all_resolutions_inference(
+			data, ari_type = ari_type, n_permutations = N_PERMS, seed = 0,
+			n_jobs = 3)
+		assert(np.array_equal(p_vals, p_vals_par))
+		assert(np.array_equal(tdp, tdp_par))
+		assert(len(clusters) == len(clusters_par))
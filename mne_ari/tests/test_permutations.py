@@ -58,3 +58,31 @@ def test_permutation_test():
 		_test_one_sample(sample_shape)
 		_test_two_sample(sample_shape)
 	
+
+def test_permutation_test_chunked(tmp_path):
+	'''
+	make sure processing tests in chunks (e.g. of a memory-mapped array)
+	replays the same permutations as processing them all at once
+	'''
+	np.random.seed(0)
+	sample_shape = [20, 15]
+	data1 = np.random.normal(size = [30] + sample_shape)
+	data2 = np.random.normal(size = [25] + sample_shape)
+	mmap = np.memmap(tmp_path / 'data.dat', dtype = data1.dtype,
+		mode = 'w+', shape = data1.shape)
+	mmap[:] = data1
+	for tail in (-1, 0, 1):
+		p = permutation_test(data1, tail = tail,
+			n_permutations = N_PERM, seed = 0)
+		p_chunked = permutation_test(mmap, tail = tail,
+			n_permutations = N_PERM, seed = 0, chunk_size = 32)
+		assert_allclose(p, p_chunked)
+		# non-contiguous inputs shouldn't need to be copied to be chunked
+		p_chunked = permutation_test(np.asfortranarray(data1), tail = tail,
+			n_permutations = N_PERM, seed = 0, chunk_size = 32)
+		assert_allclose(p, p_chunked)
+		p = permutation_test([data1, data2], tail = tail,
+			n_permutations = N_PERM, seed = 0)
+		p_chunked = permutation_test([mmap, data2], tail = tail,
+			n_permutations = N_PERM, seed = 0, chunk_size = 32)
+		assert_allclose(p, p_chunked)